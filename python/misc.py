@@ -1,17 +1,36 @@
 #!/usr/bin/env python3
 
 from git import Repo, Commit
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from queue import Queue
+from collections import deque
+from threading import Event, Thread
+from typing import Any, Deque, Iterable, Iterator, List, Optional
 import json
+import re
+import sys
+import timeit
+
+
+def walk_base(repo: Repo, base: Commit, head: Commit) -> Iterator[Commit]:
+    """
+    Lazily yield commits from head back to base (inclusive of base, exclusive of head)
+    The commit graph is read in a single rev-list pass, which only emits commits on an ancestry path
+    between the two, each exactly once and never before one of its descendants
+    """
+    connected = False
+    for commit in repo.iter_commits(f"{base.hexsha}..{head.hexsha}", ancestry_path=True, topo_order=True):
+        connected = True
+        if commit != head:
+            yield commit
+    if connected:
+        yield base
 
 
 # Print commits from head back to base
 def track_base(repo: Repo, base: Commit, head: Commit):
-    sha: Commit
-    for sha in head.parents:
-        if(head != base and repo.is_ancestor(base, sha)):
-            print(sha)
-            track_base(base, sha)
+    for sha in walk_base(repo, base, head):
+        print(sha)
 
 
 # jq wrapper
@@ -19,3 +38,225 @@ def jq(data, *args) -> dict:
     p = Popen(['jq', *args], stdin=PIPE, stdout=PIPE)
     result = p.communicate(input=bytes(json.dumps(data), 'utf-8'))
     return json.loads(result[0])
+
+
+class JqFilter:
+    """
+    Compile a jq expression once and apply it to many documents via a persistent jq co-process
+    Documents are fed as newline-delimited JSON; the filter is wrapped so every input yields exactly
+    one output line, which keeps requests and responses in lockstep even for filters like select()
+    that produce zero or several results.
+    jq's stderr (e.g. from debug) is passed through to ours, keeping the tail for error messages.
+    Only one batch() can be open at a time, and all()/__call__ can't be used while it is.
+    NOTE: extra args are for filter inputs (--arg, --argjson, ...) - output options like -r/-s are not supported
+    @param expr: jq filter expression
+    @param args: extra arguments passed to jq
+    @raise ValueError: if jq rejects the expression or arguments, or it uses input/inputs
+    """
+    def __init__(self, expr: str, *args: str):
+        self.expr = expr
+        self.args = args
+        self._busy = False
+        self._validate()
+        self._start()
+
+    def _validate(self) -> None:
+        # input/inputs would read ahead into the next documents and break the one-line-per-document pairing
+        if re.search(r'(?<![.$\w])inputs?\b', self.expr):
+            raise ValueError(f"jq expression '{self.expr}' uses input/inputs, which JqFilter does not support")
+        # Compiled in a never-taken branch, so the filter itself isn't run and can't block or emit debug output
+        check = Popen(['jq', '-n', f"if false then ({self.expr}\n) else empty end", *self.args],
+                      stdin=DEVNULL, stdout=PIPE, stderr=PIPE, text=True)
+        try:
+            _, stderr = check.communicate(timeout=10)
+        except TimeoutExpired:
+            check.kill()
+            check.communicate()
+            raise ValueError(f"timed out validating jq expression '{self.expr}'") from None
+        if check.returncode != 0:
+            # Only keep jq's own messages, the source lines it quotes are from the internal wrapper
+            errors = " ".join(line for line in stderr.splitlines() if line.startswith('jq: '))
+            if 'compile error' in errors:
+                raise ValueError(f"invalid jq expression '{self.expr}': {errors}")
+            raise ValueError(f"jq rejected arguments {list(self.args)}: {errors}")
+
+    def _start(self) -> None:
+        wrapped = f"try ([{self.expr}\n] | [true, .]) catch [false, .]"
+        # Filter goes first so --args/--jsonargs can't turn it into a positional argument
+        self._proc = Popen(['jq', '--unbuffered', '-c', wrapped, *self.args],
+                           stdin=PIPE, stdout=PIPE, stderr=PIPE, text=True)
+        self._stderr: Deque[str] = deque(maxlen=20)
+        self._stderr_thread = Thread(target=self._drain_stderr, args=(self._proc, self._stderr), daemon=True)
+        self._stderr_thread.start()
+
+    @staticmethod
+    def _drain_stderr(proc: Popen, tail: Deque[str]) -> None:
+        # Must always be read, otherwise a chatty filter fills the pipe and blocks jq
+        for line in proc.stderr:
+            tail.append(line)
+            sys.stderr.write(line)
+
+    def _stderr_tail(self) -> str:
+        self._stderr_thread.join(timeout=1)
+        return "".join(self._stderr).strip()
+
+    def _claim(self) -> None:
+        if self._busy:
+            raise RuntimeError(f"JqFilter '{self.expr}' is in use by an unfinished batch()")
+
+    def _send(self, proc: Popen, data: Any) -> None:
+        line = json.dumps(data, allow_nan=False) + "\n"
+        try:
+            proc.stdin.write(line)
+            proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            raise ValueError(f"jq exited for '{self.expr}'") from None
+
+    def _parse(self, line: str) -> List[Any]:
+        if not line:
+            raise ValueError(f"jq exited ({self._proc.wait()}) for '{self.expr}': {self._stderr_tail()}")
+        ok, value = json.loads(line)
+        if not ok:
+            raise ValueError(f"jq error in '{self.expr}': {value}")
+        return value
+
+    def all(self, data: Any) -> List[Any]:
+        """
+        Apply filter to a single document
+        @return: list of all results produced by the filter
+        """
+        self._claim()
+        self._send(self._proc, data)
+        return self._parse(self._proc.stdout.readline())
+
+    def __call__(self, data: Any) -> Optional[Any]:
+        """
+        Apply filter to a single document
+        @return: first result produced by the filter, or None if there was none
+        """
+        results = self.all(data)
+        return results[0] if results else None
+
+    def batch(self, documents: Iterable[Any]) -> Iterator[List[Any]]:
+        """
+        Apply filter to many documents, streaming them through jq without waiting on each round-trip
+        Stopping early (break, close() or a per-document ValueError) stops consuming documents as well
+        @return: lazy iterator of result lists, one per input document in order
+        @raise RuntimeError: if another batch() on this filter is still open
+        """
+        self._claim()
+        self._busy = True
+        proc = self._proc
+        sent: Queue = Queue()
+        stop = Event()
+        errors: List[Exception] = []
+
+        # Writer thread required, otherwise a full stdout pipe would deadlock against a blocked stdin write
+        def writer() -> None:
+            try:
+                for document in documents:
+                    if stop.is_set():
+                        return
+                    self._send(proc, document)
+                    sent.put(True)
+            except Exception as err:
+                if not stop.is_set():
+                    errors.append(err)
+            finally:
+                sent.put(None)
+
+        thread = Thread(target=writer, daemon=True)
+        thread.start()
+        token: Optional[bool] = sent.get()
+        try:
+            while token is not None:
+                line = proc.stdout.readline()
+                token = False
+                yield self._parse(line)
+                token = sent.get()
+        finally:
+            if token is not None:
+                stop.set()
+                if thread.is_alive():
+                    # Writer may still be mid-document or waiting on the source, so jq can't be resynced
+                    self._restart()
+                else:
+                    # Writer finished, so only the responses it already sent are outstanding
+                    if token is False:
+                        token = sent.get()
+                    while token is not None:
+                        proc.stdout.readline()
+                        token = sent.get()
+            self._busy = False
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def _restart(self) -> None:
+        self._proc.kill()
+        self.close()
+        self._start()
+
+    def close(self) -> None:
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        # Closing stdout too so jq can't block on unread output while we wait
+        self._proc.stdout.close()
+        self._proc.wait()
+
+    def __enter__(self) -> 'JqFilter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def bench_jq(count: int = 500) -> None:
+    """
+    Compare per-call jq() against a reused JqFilter, both per-document and batched
+    """
+    records = [{'id': i, 'name': f"item-{i}", 'tags': ['a', 'b'], 'nested': {'ok': i % 2 == 0}}
+               for i in range(count)]
+    # No select(), as jq() can't parse the empty output it produces for filtered records
+    expr = '{id, ok: .nested.ok, tags: (.tags | map(ascii_upcase))}'
+    subprocess_time = timeit.timeit(lambda: [jq(r, '-c', expr) for r in records], number=1)
+    with JqFilter(expr) as f:
+        call_time = timeit.timeit(lambda: [f(r) for r in records], number=1)
+        batch_time = timeit.timeit(lambda: list(f.batch(records)), number=1)
+    print(f"{count} records: jq() {subprocess_time:.3f}s, "
+          f"JqFilter() {call_time:.3f}s, JqFilter.batch() {batch_time:.3f}s")
+
+
+def bench_walk_base(path: str, base: str, head: str) -> None:
+    """
+    Compare walk_base against the previous recursive walk, which ran one `git merge-base` per parent
+    NOTE: the recursive walk revisits shared ancestors, so keep the range short on merge-heavy histories
+    """
+    repo = Repo(path)
+    base_commit, head_commit = repo.commit(base), repo.commit(head)
+
+    def recursive(commit: Commit, seen: list) -> None:
+        for parent in commit.parents:
+            if commit != base_commit and repo.is_ancestor(base_commit, parent):
+                seen.append(parent)
+                recursive(parent, seen)
+
+    walk_result: list = []
+    walk_time = timeit.timeit(lambda: walk_result.extend(walk_base(repo, base_commit, head_commit)), number=1)
+    print(f"{base}..{head}: walk_base() {walk_time:.3f}s for {len(walk_result)} commits")
+    recursive_result: list = []
+    try:
+        recursive_time = timeit.timeit(lambda: recursive(head_commit, recursive_result), number=1)
+        print(f"{base}..{head}: recursive {recursive_time:.3f}s for {len(recursive_result)} commits "
+              f"({len(set(recursive_result))} unique)")
+    except RecursionError:
+        print(f"{base}..{head}: recursive overflowed the stack after {len(recursive_result)} commits")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        bench_walk_base(*sys.argv[1:])
+    else:
+        bench_jq()